@@ -23,6 +23,7 @@ class engine(Engine):
         "bool": "INTEGER",
     }
     insert_limit = 1000
+    supports_parallel_download = True
     required_opts = [
         ("table_name", "Format of table name", "{db}_{table}.csv"),
         ("data_dir", "Install directory", DATA_DIR),
@@ -53,6 +54,12 @@ class engine(Engine):
             output_tuple[0].close()
 
     def disconnect_files(self):
+        """Close the files of all the tables written"""
+        for output_tuple in self.table_names:
+            output_tuple[0].close()
+        Engine.disconnect_files(self)
+
+    def per_table_cleanup(self):
         """Close each file after being written"""
         self.file.close()
 
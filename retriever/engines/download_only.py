@@ -17,6 +17,7 @@ class engine(Engine):
         ("sub_dir", "Install directory", ""),
     ]
     all_files = set()
+    supports_parallel_download = True
 
     def table_exists(self, dbname, tablename):
         """Checks if the file to be downloaded already exists"""
@@ -15,6 +15,7 @@ class engine(Engine):
     name = "HDF5"
     abbreviation = "hdf5"
     insert_limit = 1000
+    supports_parallel_download = True
     required_opts = [
         ("file", "Enter the filename of your HDF5 file", "hdf5.h5"),
         ("table_name", "Format of table name", "{db}_{table}"),
@@ -26,6 +26,7 @@ class engine(Engine):
         "bool": "INTEGER",
     }
     insert_limit = 1000
+    supports_parallel_download = True
     required_opts = [
         ("table_name", "Format of table name", "{db}_{table}.json"),
         ("data_dir", "Install directory", DATA_DIR),
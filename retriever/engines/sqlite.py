@@ -22,6 +22,7 @@ class engine(Engine):
     }
     placeholder = "?"
     insert_limit = 1000
+    supports_parallel_download = True
     required_opts = [
         ("file", "Enter the filename of your SQLite database", "sqlite.db"),
         ("table_name", "Format of table name", "{db}_{table}"),
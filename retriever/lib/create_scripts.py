@@ -47,8 +47,8 @@ class TabularPk:
         self.resources = resources
         self.retriever = retriever
         self.retriever_minimum_version = retriever_minimum_version
-        for key, item in list(kwargs.items()):
-            setattr(self, key, item[0] if isinstance(item, tuple) else item)
+        for key, item in kwargs.items():
+            setattr(self, key, item[0] if type(item) is tuple else item)
 
     def get_resources(self,
                       file_path,
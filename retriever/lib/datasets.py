@@ -1,5 +1,6 @@
 from retriever.lib.scripts import SCRIPT_LIST, get_script, get_dataset_names_upstream
 from retriever.lib.defaults import RETRIEVER_REPOSITORY
+from retriever.lib.templates import Script, search
 
 
 def datasets(keywords=None, licenses=None):
@@ -19,9 +20,8 @@ def datasets(keywords=None, licenses=None):
     offline_scripts = set()
     if licenses:
         licenses = [i.lower() for i in licenses]
-    for script in script_list:
-        if script.name:
-            if licenses:
+        for script in script_list:
+            if script.name:
                 script_license = [
                     licence_map['name'].lower()
                     for licence_map in script.licenses
@@ -29,16 +29,12 @@ def datasets(keywords=None, licenses=None):
                 ]
                 if script_license and set(script_license).intersection(set(licenses)):
                     offline_scripts.add(script)
-                    continue
-            if keywords:
-                script_keywords = script.title + ' ' + script.name
-                if script.keywords:
-                    script_keywords = script_keywords + ' ' + '-'.join(script.keywords)
-                script_keywords = script_keywords.lower()
-                for k in keywords:
-                    if script_keywords.find(k.lower()) != -1:
-                        offline_scripts.add(script)
-                        break
+    if keywords:
+        # A script whose title, name or keywords match any keyword is listed
+        for k in keywords:
+            offline_scripts.update(
+                script for script in search(script_list, [k], Script.keyword_ident)
+                if script.name)
     # The offline scripts filtered by params
     offline_scripts = sorted(list(offline_scripts), key=lambda s: s.name.lower())
     # The scripts present in upstream retriever repository filtered by params
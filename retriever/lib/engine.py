@@ -1,13 +1,17 @@
+import bz2
 import csv
 import getpass
 import gzip
+import lzma
 import os
 import re
 import shutil
 import sys
 import tarfile
 import zipfile
+import zlib
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from math import ceil
 from urllib.request import urlretrieve
 from urllib.error import HTTPError
@@ -38,8 +42,10 @@ class Engine():
     """A generic database system. Specific database platforms will inherit
     from this class."""
 
+    _archive_types = {}
     _connection = None
     _cursor = None
+    _fmt_cache = {}
     datatypes = []
     db = None
     debug = False
@@ -50,6 +56,7 @@ class Engine():
     required_opts = []
     script = None
     spatial_support = False
+    supports_parallel_download = False
     table = None
     use_cache = True
     warnings = []
@@ -79,7 +86,15 @@ class Engine():
     def disconnect_files(self):
         """Files systems should override this method.
 
-        Enables commit per file object.
+        Called once after all the tables of a dataset are inserted.
+        """
+        self._archive_types.clear()
+        self._fmt_cache.clear()
+
+    def per_table_cleanup(self):
+        """Files systems should override this method.
+
+        Called after each table is inserted, enables commit per file object.
         """
 
     def get_connection(self):
@@ -590,11 +605,14 @@ class Engine():
         self,
         url,
         file_names=None,
-        archive_type="zip",
+        archive_type=None,
         keep_in_dir=False,
         archive_name=None,
     ):
-        """Download files from an archive into the raw data directory."""
+        """Download files from an archive into the raw data directory.
+
+        archive_type is detected from the archive when it is not given.
+        """
 
         if not archive_name:
             archive_name = filename_from_url(url)
@@ -619,14 +637,8 @@ class Engine():
         else:
             if not file_names:
                 self.download_file(url, archive_name)
-                if archive_type in ('tar', 'tar.gz'):
-                    file_names = self.extract_tar(archive_full_path, archive_dir,
-                                                  archive_type)
-                elif archive_type == 'zip':
-                    file_names = self.extract_zip(archive_full_path, archive_dir)
-                elif archive_type == 'gz':
-                    file_names = self.extract_gz(archive_full_path, archive_dir)
-                return file_names
+                return self.extract_archive_from_url(url, archive_name, archive_full_path,
+                                                     archive_dir, archive_type)
 
             archive_downloaded = bool(self.data_path)
             for file_name in file_names:
@@ -637,15 +649,106 @@ class Engine():
                     if not archive_downloaded:
                         self.download_file(url, archive_name)
                         archive_downloaded = True
-                    if archive_type == 'zip':
-                        self.extract_zip(archive_full_path, archive_dir, file_name)
-                    elif archive_type == 'gz':
-                        self.extract_gz(archive_full_path, archive_dir, file_name)
-                    elif archive_type in ('tar', 'tar.gz'):
-                        self.extract_tar(archive_full_path, archive_dir, archive_type,
-                                         file_name)
+                    self.extract_archive_from_url(url, archive_name, archive_full_path,
+                                                  archive_dir, archive_type, file_name)
             return file_names
 
+    def extract_archive(self, archive_path, archive_dir, archive_type, file_name=None):
+        """Extract a file, or all the files, of a zip, gz, tar or tar.gz archive."""
+        if archive_type == 'zip':
+            return self.extract_zip(archive_path, archive_dir, file_name)
+        if archive_type == 'gz':
+            return self.extract_gz(archive_path, archive_dir, file_name)
+        if archive_type in ('tar', 'tar.gz'):
+            return self.extract_tar(archive_path, archive_dir, archive_type, file_name)
+        return None
+
+    def extract_archive_from_url(self,
+                                 url,
+                                 archive_name,
+                                 archive_path,
+                                 archive_dir,
+                                 archive_type=None,
+                                 file_name=None):
+        """Extract a downloaded archive, using the declared type when given.
+
+        The type is detected from the first bytes of the archive when it is
+        not declared, or when extracting with the declared type fails.
+        """
+        detected_type = self.detect_archive_type(url, archive_name)
+        if not archive_type:
+            return self.extract_archive(archive_path, archive_dir, detected_type or 'zip',
+                                        file_name)
+        if archive_type == 'zip' and detected_type and detected_type != 'zip':
+            # extract_zip would report the archive as corrupt before the fallback
+            archive_type = detected_type
+        error = None
+        try:
+            extracted = self.extract_archive(archive_path, archive_dir, archive_type,
+                                             file_name)
+        except Exception as e:
+            extracted = None
+            error = e
+        if extracted is None:
+            if detected_type and detected_type != archive_type:
+                return self.extract_archive(archive_path, archive_dir, detected_type,
+                                            file_name)
+            if error:
+                raise error
+        return extracted
+
+    def download_files_from_archive_batch(self, items):
+        """Download several archives concurrently, then extract them in order.
+
+        items is a list of dicts of download_files_from_archive arguments.
+        Only the downloads run in threads, archives extracted into the same
+        directory can not be unpacked concurrently.
+        Returns the file names extracted for each item, in order.
+        """
+        downloads = OrderedDict()
+        if not hasattr(self.script, "kaggle"):
+            for item in items:
+                file_names = item.get("file_names")
+                if file_names and (self.data_path or
+                                   all(self.find_file(name) for name in file_names)):
+                    continue
+                archive_name = item.get("archive_name") or filename_from_url(item["url"])
+                downloads.setdefault(archive_name, item["url"])
+        if downloads:
+            self.create_raw_data_dir()
+            with ThreadPoolExecutor(max_workers=min(8, len(downloads))) as executor:
+                futures = [
+                    executor.submit(self.download_file, url, archive_name)
+                    for archive_name, url in downloads.items()
+                ]
+                for future in futures:
+                    future.result()
+        return [self.download_files_from_archive(**item) for item in items]
+
+    def detect_archive_type(self, url, archive_name=None):
+        """Detect the type of a downloaded archive from its first bytes.
+
+        Returns "zip", "tar", "tar.gz" or "gz", or None if the archive is
+        not downloaded or its type is not recognized. Recognized types are
+        cached by url until disconnect_files.
+        """
+        if url in self._archive_types:
+            return self._archive_types[url]
+        if not archive_name:
+            archive_name = filename_from_url(url)
+        archive_path = self.find_file(archive_name)
+        if not archive_path:
+            return None
+        try:
+            with open(archive_path, "rb") as archive_file:
+                header = archive_file.read(4096)
+        except OSError:
+            return None
+        archive_type = archive_type_from_bytes(header)
+        if archive_type:
+            self._archive_types[url] = archive_type
+        return archive_type
+
     def drop_statement(self, object_type, object_name):
         """Return drop table or database SQL statement."""
         if self:
@@ -839,8 +942,16 @@ class Engine():
         return DATA_WRITE_PATH.format(dataset=self.script.name)
 
     def format_filename(self, filename):
-        """Return full path of a file in the archive directory."""
-        return os.path.join(self.format_data_dir(), filename)
+        """Return full path of a file in the archive directory.
+
+        Paths are cached per data path and dataset until disconnect_files.
+        """
+        key = (self.data_path, self.script.name, filename)
+        path = self._fmt_cache.get(key)
+        if path is None:
+            path = os.path.join(self.format_data_dir(), filename)
+            self._fmt_cache[key] = path
+        return path
 
     def format_insert_value(self, value, datatype):  # pylint: disable=R0201
         """Format a value for an insert statement based on data type.
@@ -1141,6 +1252,37 @@ def skip_rows(rows, source):
     return lines
 
 
+def archive_type_from_bytes(header):
+    """Return the archive type identified by the first bytes of an archive.
+
+    Compressed archives are partially decompressed to tell a tar archive
+    from a single compressed file. Returns None for unknown types.
+    """
+    if header.startswith(b"PK\x03\x04"):
+        return "zip"
+    if header[257:262] == b"ustar":
+        return "tar"
+    if header.startswith(b"\x1f\x8b"):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif header.startswith(b"BZh"):
+        decompressor = bz2.BZ2Decompressor()
+    elif header.startswith(b"\xfd7zXZ\x00"):
+        decompressor = lzma.LZMADecompressor()
+    else:
+        return None
+    try:
+        content = decompressor.decompress(header)
+    except (zlib.error, OSError, EOFError, lzma.LZMAError):
+        content = b""
+    if content[257:262] == b"ustar":
+        # tarfile detects the compression of tar archives itself
+        return "tar.gz" if header.startswith(b"\x1f\x8b") else "tar"
+    if header.startswith(b"\x1f\x8b"):
+        return "gz"
+    # Single bzip2 or xz files are not supported by the extractors
+    return None
+
+
 def file_exists(path):
     """Return true if a file exists and its size is greater than 0."""
     return os.path.isfile(path) and os.path.getsize(path) > 0
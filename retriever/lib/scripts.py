@@ -18,6 +18,7 @@ from retriever.lib.defaults import (REPOSITORY, RETRIEVER_REPOSITORY, RETRIEVER_
                                     RETRIEVER_DATASETS)
 from retriever.lib.load_json import read_json
 from retriever.lib.provenance_tools import get_script_provenance
+from retriever.lib.templates import reset_search_index
 
 global_script_list = None
 
@@ -103,6 +104,7 @@ def reload_scripts():
                                                                str(e)))
     if global_script_list:
         global_script_list.set_scripts(modules)
+    reset_search_index()
     return modules
 
 
@@ -4,7 +4,33 @@ functions available for inheritance by the scripts or datasets.
 """
 from __future__ import print_function
 
-from retriever.engines import choose_engine
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    # Optional, speeds up matching many search terms at once
+    import ahocorasick
+except ModuleNotFoundError:
+    ahocorasick = None
+
+from retriever.lib.engine import filename_from_url
+
+_search_index = {}
+_UNSET = object()
+_DEFAULT_LICENSES = ({'name': None},)
+
+TablePlan = namedtuple("TablePlan",
+                       ["table", "url", "archived", "tabular", "dataset_type", "kind"])
+
+# Source attributes that need a conversion to csv, in order of precedence
+SOURCE_KINDS = (
+    ("xls_sheets", "xls"),
+    ("geojson_data", "geojson"),
+    ("sqlite_data", "sqlite"),
+    ("json_data", "json"),
+    ("xml_data", "xml"),
+    ("hdf5_data", "hdf5"),
+)
 
 
 class Script():
@@ -14,48 +40,57 @@ class Script():
     it's Unique functionality.
     """
 
+    _ident = None
+    _keyword_ident = None
+    _reference_url = _UNSET
+
     def __init__(self,
                  title="",
                  description="",
                  name="",
-                 urls=dict(),
-                 tables=dict(),
+                 urls=None,
+                 tables=None,
                  ref="",
                  public=True,
                  addendum=None,
                  citation="Not currently available",
-                 licenses=[{
-                     'name': None
-                 }],
+                 licenses=None,
                  retriever_minimum_version="",
                  version="",
                  encoding="utf-8",
                  message="",
                  **kwargs):
 
-        self.title = title
-        self.name = name
-        self.filename = __name__
-        self.description = description
-        self.urls = urls
-        self.tables = tables
-        self.ref = ref
-        self.public = public
-        self.addendum = addendum
-        self.citation = citation
-        self.licenses = licenses
-        self.keywords = []
-        self.retriever_minimum_version = retriever_minimum_version
-        self.encoding = encoding
-        self.version = version
-        self.message = message
-        for key, item in list(kwargs.items()):
-            setattr(self, key, item[0] if isinstance(item, tuple) else item)
+        self.__dict__.update({
+            'title': title,
+            'name': name,
+            'filename': __name__,
+            'description': description,
+            'urls': urls if urls is not None else {},
+            'tables': tables if tables is not None else {},
+            'ref': ref,
+            'public': public,
+            'addendum': addendum,
+            'citation': citation,
+            'licenses': (licenses if licenses is not None else
+                         [dict(item) for item in _DEFAULT_LICENSES]),
+            'keywords': [],
+            'retriever_minimum_version': retriever_minimum_version,
+            'encoding': encoding,
+            'version': version,
+            'message': message,
+        })
+        self.__dict__.update({
+            key: item[0] if type(item) is tuple else item for key, item in kwargs.items()
+        })
+        if self.keywords is None:
+            self.keywords = []
 
     def __str__(self):
         desc = self.name
-        if self.reference_url():
-            desc += "\n" + self.reference_url()
+        reference_url = self.reference_url()
+        if reference_url:
+            desc += "\n" + reference_url
         return desc
 
     def download(self, engine=None, debug=False):
@@ -66,16 +101,30 @@ class Script():
         self.engine.create_db()
 
     def reference_url(self):
-        """Get a reference url as the parent url from data url"""
-        if self.ref:
-            return self.ref
-        if len(self.urls) == 1:
-            return self.urls[list(self.urls.keys())[0]]
-        return None
+        """Get a reference url as the parent url from data url
+
+        The url is computed on the first call and cached, call
+        _invalidate_ref after replacing ref or urls.
+        """
+        if self._reference_url is _UNSET:
+            if self.ref:
+                self._reference_url = self.ref
+            elif len(self.urls) == 1:
+                self._reference_url = next(iter(self.urls.values()))
+            else:
+                self._reference_url = None
+        return self._reference_url
+
+    def _invalidate_ref(self):
+        """Drop the cached reference url"""
+        self._reference_url = _UNSET
 
     def checkengine(self, engine=None):
         """Returns the required engine instance"""
         if engine is None:
+            # Importing the engines loads every database driver,
+            # only do it when a script is installed without an engine
+            from retriever.engines import choose_engine
             opts = {}
             engine = choose_engine(opts)
         engine.get_input()
@@ -83,18 +132,47 @@ class Script():
         engine.set_engine_encoding()
         return engine
 
-    def matches_terms(self, terms):
-        """Check if the terms matches a script metadata info"""
-        try:
-            search_string = ' '.join([self.name, self.description, self.name] +
-                                     self.keywords).upper()
-
-            for term in terms:
-                if not term.upper() in search_string:
-                    return False
-            return True
-        except BaseException:
+    def search_ident(self):
+        """Return the uppercased identifier used to match search terms
+
+        Name, description and keywords are joined with a unit separator so a
+        term can not match across two fields. Each field appears once, ranking
+        name matches higher should weight the fields rather than repeat the
+        name. The identifier is built on first use, after script subclasses
+        have set their metadata, and cached.
+        """
+        if self._ident is None:
+            fields = [self.name or "", self.description or ""]
+            fields.extend(self.keywords or [])
+            self._ident = '\x1f'.join(fields).upper()
+        return self._ident
+
+    def keyword_ident(self):
+        """Return the uppercased title, name and keywords matched by datasets()"""
+        if self._keyword_ident is None:
+            ident = (self.title or "") + ' ' + (self.name or "")
+            if self.keywords:
+                ident = ident + ' ' + '-'.join(self.keywords)
+            self._keyword_ident = ident.upper()
+        return self._keyword_ident
+
+    def matches_terms(self, terms, upper_terms=None):
+        """Check if the terms matches a script metadata info
+
+        Callers matching the same terms against many scripts can pass
+        ``upper_terms`` to avoid uppercasing the terms for every script.
+        """
+        if terms is None and upper_terms is None:
             return False
+        ident = self.search_ident()
+        if upper_terms is None:
+            upper_terms = (term.upper() for term in terms)
+        return all(term in ident for term in upper_terms)
+
+    def reset_search_cache(self):
+        """Drop the cached search identifiers after the metadata changes"""
+        self._ident = None
+        self._keyword_ident = None
 
 
 class BasicTextTemplate(Script):
@@ -105,49 +183,117 @@ class BasicTextTemplate(Script):
     Scripts that require extra tune up, should override this class.
     """
 
-    def __init__(self, **kwargs):
-        Script.__init__(self, **kwargs)
-        for key in kwargs:
-            setattr(self, key, kwargs[key])
+    _table_plan = None
+    _table_plan_tables = None
+
+    def table_plan(self):
+        """Return the TablePlan of each table, in the order of the tables
+
+        The plan is rebuilt when a table is added, removed or replaced.
+        Changes to the attributes of a table object are not tracked.
+        """
+        tables = tuple(self.tables.items())
+        if self._table_plan is None or self._table_plan_tables != tables:
+            script_archived = hasattr(self, "archived")
+            script_url = getattr(self, "url", None)
+            self._table_plan = [
+                TablePlan(
+                    table=table_obj,
+                    # if the table has no url, use the script's url
+                    url=getattr(table_obj, "url", None) or script_url,
+                    archived=script_archived or hasattr(table_obj, "archived"),
+                    tabular=getattr(table_obj, "format", None) == "tabular",
+                    dataset_type=getattr(table_obj, "dataset_type", None),
+                    kind=table_kind(table_obj),
+                ) for _, table_obj in tables
+            ]
+            self._table_plan_tables = tables
+        return self._table_plan
 
     def download(self, engine=None, debug=False):
         """Defines the download processes for scripts that utilize the default
         pre processing steps provided by the retriever."""
         Script.download(self, engine, debug)
-        # make file name mandatory for simplicity
-
-        for _, table_obj in self.tables.items():
-            # if the table has no url, use the script's url
-            if hasattr(table_obj, "url") and table_obj.url:
-                url = table_obj.url
-            elif self.url:
-                url = self.url
-
-            # Extract archived files if a resource or the script has archived
-            if hasattr(self, "archived") or hasattr(table_obj, "archived"):
-                self.process_archived_data(table_obj, url)
-
-            # Create tables
-            if hasattr(table_obj, "format") and table_obj.format == "tabular":
-                self.process_tables(table_obj, url)
-            elif hasattr(self.engine, "spatial_support"):
-                if self.engine.spatial_support:
-                    self.process_tables(table_obj, url)
+        try:
+            self.prefetch_files()
+            extracted = self.extract_archives()
+            for plan in self.table_plan():
+                table_obj = plan.table
+                url = plan.url
+
+                # Extract archived files if a resource or the script has archived
+                if plan.archived and table_obj not in extracted:
+                    self.process_archived_data(table_obj, url)
+
+                # Create tables
+                if plan.tabular or self.engine.spatial_support:
+                    self.process_tables(table_obj, url, plan.kind)
                 else:
                     print("Engine {eng} does not support spatial "
                           "processing".format(eng=self.engine.name))
                     return
 
-            # insert data procedures
-            if hasattr(table_obj, "dataset_type"):
-                if table_obj.dataset_type in ["RasterDataset", "VectorDataset"]:
-                    self.process_spatial_insert(table_obj)
-                    continue
+                # insert data procedures
+                if plan.dataset_type:
+                    if plan.dataset_type in ["RasterDataset", "VectorDataset"]:
+                        self.process_spatial_insert(table_obj)
+                        continue
 
-                # assume tabular
-                self.process_tabular_insert(table_obj, url)
+                    # assume tabular
+                    self.process_tabular_insert(table_obj, url)
+                    self.engine.per_table_cleanup()
+        finally:
             self.engine.disconnect_files()
 
+    def prefetch_files(self):
+        """Download the raw files of the tabular tables concurrently
+
+        Archived tables are left to extract_archives. Only the network
+        transfers run in threads. Extraction, conversion
+        and inserts stay in the serial download loop, which then finds the
+        files in the raw data directory.
+        """
+        if not self.engine.supports_parallel_download or hasattr(self, "kaggle"):
+            return
+        downloads = {}
+        for plan in self.table_plan():
+            table_obj = plan.table
+            url = plan.url
+            # archives are fetched by extract_archives
+            if not plan.tabular or not url or plan.archived:
+                continue
+            filename = table_source_file(table_obj, url, plan.kind)
+            downloads.setdefault(filename, url)
+
+        if len(downloads) < 2:
+            return
+        self.engine.create_raw_data_dir()
+        with ThreadPoolExecutor(max_workers=min(8, len(downloads))) as executor:
+            futures = [
+                executor.submit(self.engine.download_file, url, filename)
+                for filename, url in downloads.items()
+            ]
+            for future in futures:
+                future.result()
+
+    def extract_archives(self):
+        """Fetch the archives of the tabular tables concurrently and extract them
+
+        Returns the table objects whose archives were extracted, the
+        download loop skips process_archived_data for them.
+        """
+        if not self.engine.supports_parallel_download or hasattr(self, "kaggle"):
+            return []
+        plans = [
+            plan for plan in self.table_plan()
+            if plan.archived and plan.tabular and plan.url
+        ]
+        if len(plans) < 2:
+            return []
+        self.engine.download_files_from_archive_batch(
+            [self.archive_args(plan.table, plan.url) for plan in plans])
+        return [plan.table for plan in plans]
+
     def process_tabular_insert(self, table_obj, url):
         """Process tabular data for insertion"""
         if hasattr(self, "archived") or hasattr(table_obj, "path"):
@@ -163,36 +309,33 @@ class BasicTextTemplate(Script):
         elif table_obj.dataset_type == "VectorDataset":
             self.engine.insert_vector(self.engine.format_filename(table_obj.path))
 
-    def process_tables(self, table_obj, url):
+    def process_tables(self, table_obj, url, kind=None):
         """Obtain the clean file and create a table
 
-        if xls_sheets, convert excel to csv
-        Create the table from the file
+        if xls_sheets, convert excel to csv, likewise for the other
+        source kinds, then create the table from the file
         """
-        if hasattr(table_obj, "xls_sheets"):
-            src_path = self.engine.format_filename(table_obj.xls_sheets[1])
+        if kind is None:
+            kind = table_kind(table_obj)
+
+        if kind != "tabular":
+            source_file = table_source_file(table_obj, url, kind)
+            src_path = self.engine.format_filename(source_file)
             path_to_csv = self.engine.format_filename(table_obj.path)
-            self.engine.download_file(url, table_obj.xls_sheets[1])
+            self.engine.download_file(url, source_file)
+
+        if kind == "xls":
             self.engine.excel_to_csv(src_path, path_to_csv, table_obj.xls_sheets,
                                      self.encoding)
 
-        if hasattr(table_obj, "geojson_data"):
-            src_path = self.engine.format_filename(table_obj.geojson_data)
-            path_to_csv = self.engine.format_filename(table_obj.path)
-            self.engine.download_file(url, table_obj.geojson_data)
+        elif kind == "geojson":
             self.engine.process_geojson2csv(src_path, path_to_csv)
 
-        if hasattr(table_obj, "sqlite_data"):
-            src_path = self.engine.format_filename(table_obj.sqlite_data[1])
-            path_to_csv = self.engine.format_filename(table_obj.path)
-            self.engine.download_file(url, table_obj.sqlite_data[1])
+        elif kind == "sqlite":
             self.engine.process_sqlite2csv(src_path, path_to_csv,
                                            table_obj.sqlite_data[0])
 
-        if hasattr(table_obj, "json_data"):
-            src_path = self.engine.format_filename(table_obj.json_data)
-            path_to_csv = self.engine.format_filename(table_obj.path)
-            self.engine.download_file(url, table_obj.json_data)
+        elif kind == "json":
             # schema_fields = None
 
             schema_fields = None
@@ -204,10 +347,7 @@ class BasicTextTemplate(Script):
 
             self.engine.process_json2csv(src_path, path_to_csv, schema_fields)
 
-        if hasattr(table_obj, "xml_data"):
-            src_path = self.engine.format_filename(table_obj.xml_data)
-            path_to_csv = self.engine.format_filename(table_obj.path)
-            self.engine.download_file(url, table_obj.xml_data)
+        elif kind == "xml":
             schema_fields = None
             empty_rows = 1
             if hasattr(table_obj, "empty_rows"):
@@ -218,18 +358,14 @@ class BasicTextTemplate(Script):
 
             self.engine.process_xml2csv(src_path, path_to_csv, schema_fields, empty_rows)
 
-        if hasattr(table_obj, "hdf5_data"):
-            src_path = self.engine.format_filename(table_obj.hdf5_data[0])
-            path_to_csv = self.engine.format_filename(table_obj.path)
-            self.engine.download_file(url, table_obj.hdf5_data[0])
+        elif kind == "hdf5":
             data_type = table_obj.hdf5_data[1]
             data_name = table_obj.hdf5_data[2]
             self.engine.process_hdf52csv(src_path, path_to_csv, data_name, data_type)
 
-        if hasattr(table_obj, "path"):
-            self.engine.auto_create_table(table_obj, url=url, filename=table_obj.path)
-        else:
-            self.engine.auto_create_table(table_obj, url=url)
+        self.engine.auto_create_table(table_obj,
+                                      url=url,
+                                      filename=getattr(table_obj, "path", None))
 
     def process_archived_data(self, table_obj, url):
         """Pre-process archived files.
@@ -240,7 +376,11 @@ class BasicTextTemplate(Script):
         If the archived data is excel, use the
         xls_sheets to obtain the files to be extracted.
         """
-        archive_type = "zip"
+        self.engine.download_files_from_archive(**self.archive_args(table_obj, url))
+
+    def archive_args(self, table_obj, url):
+        """Return the download_files_from_archive arguments for a table"""
+        archive_type = None
         keep_in_dir = False
         archive_name = None
         files = None
@@ -266,15 +406,150 @@ class BasicTextTemplate(Script):
         if hasattr(self, "archive_name"):
             archive_name = self.archive_name
 
-        self.engine.download_files_from_archive(url=url,
-                                                file_names=files,
-                                                archive_type=archive_type,
-                                                keep_in_dir=keep_in_dir,
-                                                archive_name=archive_name)
+        return {
+            "url": url,
+            "file_names": files,
+            "archive_type": archive_type,
+            "keep_in_dir": keep_in_dir,
+            "archive_name": archive_name,
+        }
+
+
+def table_kind(table_obj):
+    """Return the kind of source a table is created from
+
+    One of the SOURCE_KINDS, or "tabular" if the table is read directly.
+    """
+    for attribute, kind in SOURCE_KINDS:
+        if hasattr(table_obj, attribute):
+            return kind
+    return "tabular"
+
+
+def table_source_file(table_obj, url, kind=None):
+    """Return the name of the raw file a table is created from
+
+    For the SOURCE_KINDS this is the file converted to csv, otherwise the
+    table path or the file name of the url.
+    """
+    if kind is None:
+        kind = table_kind(table_obj)
+    if kind == "xls":
+        return table_obj.xls_sheets[1]
+    if kind == "sqlite":
+        return table_obj.sqlite_data[1]
+    if kind == "hdf5":
+        return table_obj.hdf5_data[0]
+    if kind == "geojson":
+        return table_obj.geojson_data
+    if kind == "json":
+        return table_obj.json_data
+    if kind == "xml":
+        return table_obj.xml_data
+    return getattr(table_obj, "path", None) or filename_from_url(url)
 
 
 class HtmlTableTemplate(Script):
     """Script template for parsing data in HTML tables."""
 
 
+def build_search_index(scripts, ident=None):
+    """Map each uppercased metadata word to the names of the scripts using it
+
+    ``ident`` returns the identifier of a script, Script.search_ident by default.
+    """
+    ident = ident or Script.search_ident
+    index = {}
+    for script in scripts:
+        for token in ident(script).split():
+            index.setdefault(token, set()).add(script.name)
+    return {token: frozenset(names) for token, names in index.items()}
+
+
+def matches_terms_bulk(scripts, terms):
+    """Return the scripts whose metadata matches all the terms
+
+    With pyahocorasick installed all the terms are compiled into a single
+    automaton which scans each script identifier once. Otherwise every
+    script is checked with Script.matches_terms.
+    """
+    if terms is None:
+        return []
+    upper_terms = [term.upper() for term in terms]
+    if ahocorasick is None:
+        return [script for script in scripts if script.matches_terms(terms, upper_terms)]
+
+    # An empty term matches every script
+    term_set = {term for term in upper_terms if term}
+    if not term_set:
+        return list(scripts)
+    automaton = ahocorasick.Automaton()
+    for term in term_set:
+        automaton.add_word(term, term)
+    automaton.make_automaton()
+
+    matches = []
+    for script in scripts:
+        found = set()
+        for _, term in automaton.iter(script.search_ident()):
+            found.add(term)
+            if len(found) == len(term_set):
+                matches.append(script)
+                break
+    return matches
+
+
+def get_search_index(scripts, ident=None):
+    """Return the search index of the scripts, built on first use
+
+    One index is kept per identifier and rebuilt when called with a
+    different script list.
+    """
+    ident = ident or Script.search_ident
+    cached = _search_index.get(ident)
+    if cached is None or cached[0] is not scripts:
+        cached = (scripts, build_search_index(scripts, ident))
+        _search_index[ident] = cached
+    return cached[1]
+
+
+def search(scripts, terms, ident=None):
+    """Return the scripts whose metadata contains all the terms
+
+    Terms without whitespace are resolved from the search index, the
+    postings of every indexed word containing the term are merged and the
+    sets of the terms are intersected. Only the remaining candidates are
+    checked for the other terms with a substring search. ``ident`` returns
+    the identifier matched for a script, Script.search_ident by default.
+    """
+    ident = ident or Script.search_ident
+    index = get_search_index(scripts, ident)
+    candidates = None
+    substring_terms = []
+    for term in terms:
+        term = term.upper()
+        if not term:
+            continue
+        if term.split() != [term]:
+            substring_terms.append(term)
+            continue
+        names = set()
+        for token, postings in index.items():
+            if term in token:
+                names.update(postings)
+        candidates = names if candidates is None else candidates & names
+        if not candidates:
+            return []
+    return [
+        script for script in scripts
+        if (candidates is None or script.name in candidates) and all(
+            term in ident(script) for term in substring_terms)
+    ]
+
+
+def reset_search_index():
+    """Drop the cached search indexes, used when the scripts are reloaded"""
+    _search_index.clear()
+
+
 TEMPLATES = {"default": BasicTextTemplate, "html_table": HtmlTableTemplate}
@@ -107,6 +107,9 @@ setup(
         'h5py',
         'Pillow'
     ],
+    extras_require={
+        'search': ['pyahocorasick'],
+    },
     data_files=[('', ['CITATION'])],
     setup_requires=[],
 )
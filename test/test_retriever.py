@@ -9,12 +9,14 @@ import pytest
 import requests
 import retriever as rt
 from retriever.lib.cleanup import correct_invalid_value
-from retriever.lib.engine import Engine
+from retriever.lib.engine import Engine, archive_type_from_bytes, filename_from_url
 from retriever.lib.engine_tools import getmd5
+from retriever.engines.csvengine import engine as CSVEngine
 from retriever.lib.engine_tools import json2csv
 from retriever.lib.engine_tools import xml2csv_test
 from retriever.lib.table import TabularDataset
-from retriever.lib.templates import BasicTextTemplate
+from retriever.lib.templates import BasicTextTemplate, Script, build_search_index, matches_terms_bulk, search
+from retriever.lib.templates import table_kind, table_source_file
 from retriever.lib.socrata import update_socrata_contents, create_socrata_dataset
 from retriever.lib.rdatasets import update_rdataset_contents, create_rdataset
 from retriever.lib.tools import excel_csv
@@ -485,6 +487,98 @@ def test_get_script():
     assert script.name == 'abalone-age'
 
 
+def test_matches_terms():
+    """Checks if matches_terms matches terms against the script metadata"""
+    script = BasicTextTemplate(**{"name": "bird-size",
+                                  "description": "Bird body size data",
+                                  "keywords": ["birds", "morphology"]})
+    assert script.matches_terms(["bird", "MORPH"])
+    assert script.matches_terms(["size"], upper_terms=["SIZE"])
+    assert not script.matches_terms(["bird", "mammal"])
+    assert not script.matches_terms(["data birds"])
+    assert not script.matches_terms(None)
+    assert BasicTextTemplate(**{"name": "test", "keywords": None}).matches_terms(["test"])
+    script.keywords.append("mammals")
+    script.reset_search_cache()
+    assert script.matches_terms(["bird", "mammal"])
+
+
+def test_search():
+    """Checks if search agrees with matches_terms"""
+    birds = BasicTextTemplate(**{"name": "bird-size",
+                                 "description": "Bird body size data",
+                                 "keywords": ["birds"]})
+    fish = BasicTextTemplate(**{"name": "fish-stock",
+                                "description": "Fish stocked by species",
+                                "keywords": ["fish"]})
+    scripts = [birds, fish]
+    index = build_search_index(scripts)
+    assert index["BIRDS"] == frozenset(["bird-size"])
+    for terms in [["birds"], ["bird", "size"], ["fish"], ["stock", "data"], ["body size"],
+                  ["spec"], ["bird", "data"], []]:
+        assert search(scripts, terms) == [
+            script for script in scripts if script.matches_terms(terms)
+        ]
+    # datasets() matches the title, name and keywords, not the description
+    birds.title = "Avian measurements"
+    birds.reset_search_cache()
+    assert search(scripts, ["avian"], Script.keyword_ident) == [birds]
+    assert search(scripts, ["bird-size birds"], Script.keyword_ident) == [birds]
+    assert search(scripts, ["stocked"], Script.keyword_ident) == []
+
+
+@pytest.mark.parametrize("use_automaton", [True, False])
+def test_matches_terms_bulk(monkeypatch, use_automaton):
+    """Checks if matches_terms_bulk returns the scripts matching all terms"""
+    if use_automaton:
+        pytest.importorskip("ahocorasick")
+    else:
+        monkeypatch.setattr("retriever.lib.templates.ahocorasick", None)
+    birds = BasicTextTemplate(**{"name": "bird-size",
+                                 "description": "Bird body size data",
+                                 "keywords": ["birds"]})
+    fish = BasicTextTemplate(**{"name": "fish-stock",
+                                "description": "Fish stocked by species",
+                                "keywords": ["fish"]})
+    scripts = [birds, fish]
+    assert matches_terms_bulk(scripts, ["size", "BIRDS"]) == [birds]
+    assert matches_terms_bulk(scripts, ["s"]) == scripts
+    assert matches_terms_bulk(scripts, ["fish", "bird"]) == []
+    assert matches_terms_bulk(scripts, [""]) == scripts
+    assert matches_terms_bulk(scripts, None) == []
+
+
+def test_reference_url():
+    """Checks if reference_url falls back to the single data url"""
+    script = BasicTextTemplate(**{"name": "test",
+                                  "urls": {"data": "http://example.com/data.csv"}})
+    assert script.reference_url() == "http://example.com/data.csv"
+    script.ref = "http://example.com"
+    script._invalidate_ref()
+    assert script.reference_url() == "http://example.com"
+    assert str(script) == "test\nhttp://example.com"
+
+
+def test_script_default_containers():
+    """Checks that scripts built with the defaults do not share containers"""
+    first = BasicTextTemplate(**{"name": "first"})
+    second = BasicTextTemplate(**{"name": "second"})
+    first.urls["data"] = "http://example.com/data.csv"
+    first.tables["data"] = TabularDataset(name="data")
+    first.licenses[0]["name"] = "CC0-1.0"
+    assert second.urls == {}
+    assert second.tables == {}
+    assert second.licenses == [{'name': None}]
+
+
+def test_template_tuple_kwargs():
+    """Checks if single element tuple kwargs are unwrapped only once"""
+    script = BasicTextTemplate(**{"name": "test", "archived": ("zip",),
+                                  "keywords": (["birds"],)})
+    assert script.archived == "zip"
+    assert script.keywords == ["birds"]
+
+
 def test_get_retriever_script_version():
     """Checks if get_script_version return version of scripts"""
     scripts_version_list = get_retriever_script_versions()
@@ -680,6 +774,207 @@ def test_download_archive_zip_unkown():
     assert ['sample_zip.csv'] <= files
 
 
+def test_prefetch_files():
+    """Download the files of all tables of a script concurrently"""
+    setup_functions()
+    engine = Engine()
+    engine.supports_parallel_download = True
+    engine.opts = {'database_name': '{db}_abc'}
+    tables = {
+        "zip": TabularDataset(name="zip", url=zip_url, path="sample_zip.zip",
+                              format="tabular"),
+        "gz": TabularDataset(name="gz", url=gz_url, path="sample.gz", format="tabular")
+    }
+    script = BasicTextTemplate(**{"tables": tables, "name": "test"})
+    script.engine = engine
+    engine.script = script
+    script.prefetch_files()
+    assert engine.find_file("sample_zip.zip")
+    assert engine.find_file("sample.gz")
+
+
+def test_download_multiple_tables(tmpdir):
+    """Install a script with plain and archived tables using the csv engine"""
+    setup_functions()
+    engine = CSVEngine()
+    engine.opts = {"table_name": "{db}_{table}.csv", "data_dir": str(tmpdir)}
+    source_dir = tmpdir.mkdir("source")
+    for table_name in ["plain1", "plain2"]:
+        source_dir.join(table_name + ".csv").write("a,b\n1,2\n")
+    tables = {
+        "plain1": TabularDataset(name="plain1",
+                                 url="file://" + str(source_dir.join("plain1.csv")),
+                                 format="tabular", dataset_type="TabularDataset"),
+        "plain2": TabularDataset(name="plain2",
+                                 url="file://" + str(source_dir.join("plain2.csv")),
+                                 format="tabular", dataset_type="TabularDataset"),
+        "zip": TabularDataset(name="zip", url=zip_url, archived="zip",
+                              path="sample_zip.csv", format="tabular",
+                              dataset_type="TabularDataset"),
+        "tar": TabularDataset(name="tar", url=tar_gz_url, archived="tar.gz",
+                              path="test/sample_tar.csv", format="tabular",
+                              dataset_type="TabularDataset")
+    }
+    script = BasicTextTemplate(**{"tables": tables, "name": "multi-table"})
+    script.download(engine)
+    header = 'this,is,a,samplefile,for,retriever,tests'
+    for table_name in ["zip", "tar"]:
+        output = tmpdir.join("multi_table_{}.csv".format(table_name))
+        assert output.read().splitlines()[0] == header
+    for table_name in ["plain1", "plain2"]:
+        output = tmpdir.join("multi_table_{}.csv".format(table_name))
+        assert output.read().splitlines() == ["a,b", "1,2"]
+    subprocess.call(['rm', '-r', engine.format_data_dir()])
+
+
+def test_table_plan():
+    """Resolve the url and the insert step of each table"""
+    tables = {
+        "first": TabularDataset(name="first", url="http://example.com/first.csv"),
+        "second": TabularDataset(name="second"),
+    }
+    script = BasicTextTemplate(**{"tables": tables, "name": "plan"})
+    first, second = script.table_plan()
+    assert first.url == "http://example.com/first.csv"
+    # A table without a url does not reuse the url of the previous table
+    assert second.url is None
+    assert first.dataset_type == "TabularDataset"
+    # Tables added in place invalidate the plan
+    tables["third"] = TabularDataset(name="third")
+    assert script.table_plan()[2].table is tables["third"]
+    script = BasicTextTemplate(**{"tables": {"first": TabularDataset(name="first")},
+                                  "url": "http://example.com/all.csv",
+                                  "name": "plan"})
+    assert script.table_plan()[0].url == "http://example.com/all.csv"
+
+
+def test_table_kind():
+    """Pick the source kind of a table in the order of SOURCE_KINDS"""
+    table = TabularDataset(name="kind", path="kind.csv")
+    assert table_kind(table) == "tabular"
+    table.hdf5_data = ["data.h5", "table", "dataset"]
+    assert table_kind(table) == "hdf5"
+    table.json_data = "data.json"
+    assert table_kind(table) == "json"
+    table.sqlite_data = ["table", "data.sqlite"]
+    assert table_kind(table) == "sqlite"
+    table.xls_sheets = ["sheet", "data.xls"]
+    assert table_kind(table) == "xls"
+
+
+def test_table_source_file():
+    """Resolve the raw file of a table from its kind, path or url"""
+    url = "http://example.com/raw/data.csv?raw=true"
+    table = TabularDataset(name="source")
+    assert table_source_file(table, url) == "data.csv"
+    table.path = "table.csv"
+    assert table_source_file(table, url) == "table.csv"
+    table.xml_data = "data.xml"
+    assert table_source_file(table, url) == "data.xml"
+    table.xls_sheets = ["sheet", "data.xls"]
+    assert table_source_file(table, url) == "data.xls"
+    # An explicit kind takes precedence over the table attributes
+    assert table_source_file(table, url, "xml") == "data.xml"
+    assert table_source_file(table, url, "tabular") == "table.csv"
+
+
+def test_download_skips_insert_without_dataset_type(tmpdir):
+    """Tables with an empty dataset type are created but not inserted"""
+    setup_functions()
+    engine = CSVEngine()
+    engine.opts = {"table_name": "{db}_{table}.csv", "data_dir": str(tmpdir)}
+    source = tmpdir.join("plain.csv")
+    source.write("a,b\n1,2\n")
+    tables = {
+        name: TabularDataset(name=name, url="file://" + str(source), format="tabular")
+        for name in ["inserted", "skipped"]
+    }
+    tables["skipped"].dataset_type = ""
+    script = BasicTextTemplate(**{"tables": tables, "name": "plan"})
+    script.download(engine)
+    assert tmpdir.join("plan_inserted.csv").read().splitlines() == ["a,b", "1,2"]
+    assert tmpdir.join("plan_skipped.csv").read().splitlines() == ["a,b"]
+    subprocess.call(['rm', '-r', engine.format_data_dir()])
+
+
+def test_archive_type_from_bytes():
+    """Identify archive types from the first bytes of the archives"""
+    headers = {}
+    for archive in [achive_zip, achive_tar, achive_tar_gz, achive_gz]:
+        with open(archive, 'rb') as archive_file:
+            headers[archive] = archive_file.read(4096)
+    assert archive_type_from_bytes(headers[achive_zip]) == 'zip'
+    assert archive_type_from_bytes(headers[achive_tar]) == 'tar'
+    assert archive_type_from_bytes(headers[achive_tar_gz]) == 'tar.gz'
+    # sample.gz holds a tar archive
+    assert archive_type_from_bytes(headers[achive_gz]) == 'tar.gz'
+    assert archive_type_from_bytes(b'User,Country,Age') is None
+
+
+def test_detect_archive_type():
+    """Fall back to the detected type when the declared type fails"""
+    setup_functions()
+    test_engine.download_files_from_archive(url=zip_url, archive_type='tar')
+    assert test_engine.detect_archive_type(zip_url) == 'zip'
+    assert test_engine.find_file('sample_zip.csv')
+    test_engine.disconnect_files()
+    assert not test_engine._archive_types
+
+
+def test_detect_archive_type_not_downloaded():
+    """Archives that are not downloaded are detected once they are"""
+    setup_functions()
+    assert test_engine.detect_archive_type(tar_gz_url) is None
+    test_engine.download_file(tar_gz_url, filename_from_url(tar_gz_url))
+    assert test_engine.detect_archive_type(tar_gz_url) == 'tar.gz'
+
+
+def test_declared_zip_fallback_is_quiet(capsys):
+    """A tar.gz archive declared as zip is extracted without a corrupt warning"""
+    setup_functions()
+    test_engine.download_files_from_archive(url=tar_gz_url,
+                                            file_names=['test/sample_tar.csv'],
+                                            archive_type='zip')
+    assert test_engine.find_file('test/sample_tar.csv')
+    assert "may be corrupt" not in capsys.readouterr().out
+
+
+def test_declared_archive_type_wins():
+    """Extract with the declared type when it works, detect it when missing"""
+    setup_functions()
+    test_engine.download_files_from_archive(url=gz_url,
+                                            file_names=['test/sample_tar.csv'],
+                                            archive_type='gz')
+    # sample.gz holds a tar archive, extract_gz writes the whole tar stream
+    with open(test_engine.find_file('test/sample_tar.csv'), 'rb') as extracted:
+        assert extracted.read()[257:262] == b'ustar'
+    setup_functions()
+    test_engine.download_files_from_archive(url=gz_url,
+                                            file_names=['test/sample_tar.csv'])
+    with open(test_engine.find_file('test/sample_tar.csv')) as extracted:
+        assert extracted.readline().startswith('This, is, a, samplefile')
+
+
+def test_download_files_from_archive_batch():
+    """Download and extract known files from several archives concurrently"""
+    setup_functions()
+    files = test_engine.download_files_from_archive_batch([
+        {'url': zip_url, 'file_names': ['sample_zip.csv'], 'archive_type': 'zip'},
+        {'url': tar_gz_url, 'file_names': ['test/sample_tar.csv'],
+         'archive_type': 'tar.gz'},
+    ])
+    assert files == [['sample_zip.csv'], ['test/sample_tar.csv']]
+    assert test_engine.find_file('sample_zip.csv')
+    assert test_engine.find_file('test/sample_tar.csv')
+    setup_functions()
+    files = test_engine.download_files_from_archive_batch([
+        {'url': tar_url, 'archive_type': 'tar'},
+        {'url': tar_gz_url, 'archive_type': 'tar.gz'},
+    ])
+    assert 'test/sample_tar.csv' in files[0]
+    assert 'test/sample_tar.csv' in files[1]
+
+
 def test_extract_known_tar():
     """Test extraction of known tarred filename"""
     setup_functions()
@@ -825,6 +1120,18 @@ def test_format_filename():
            os.path.normpath(os.path.join(HOMEDIR, r_path))
 
 
+def test_format_filename_cache():
+    """Test that cached filenames follow the dataset and reset on disconnect."""
+    test_engine.script.name = "TestName"
+    first = test_engine.format_filename('testfile.csv')
+    assert test_engine.format_filename('testfile.csv') is first
+    test_engine.script.name = "OtherName"
+    assert 'OtherName' in test_engine.format_filename('testfile.csv')
+    test_engine.disconnect_files()
+    assert not test_engine._fmt_cache
+    test_engine.script.name = "TestName"
+
+
 def test_format_insert_value_int():
     """Test formatting of values for insert statements."""
     assert test_engine.format_insert_value(42, 'int') == 42